@@ -5,16 +5,28 @@ import logging
 import os
 import sys
 import time
-from typing import Final
+from typing import Dict, Final
 
 import prometheus_client
 import yaml
 
-from sesame_exporter._impl import update_metrics
+from sesame_exporter._impl import (
+    init,
+    seconds_until_next_refresh,
+    shutdown,
+    update_metrics,
+)
+
+# Use the libyaml-based loader when available, it is much faster.
+try:
+    from yaml import CSafeLoader as _YamlLoader
+except ImportError:  # libyaml is not available
+    from yaml import SafeLoader as _YamlLoader  # type: ignore[assignment]
 
 _DEFAULT_PORT: Final[int] = 8000
 
-# Poll every 10 seconds. there is also client-side caching in client implementation.
+# Minimum wait between polls. The main loop sleeps until the next device is due
+# for a refresh, but never less than this.
 _POLL_INTERVAL: Final[int] = 10
 
 
@@ -33,7 +45,7 @@ def _parse_args():
     if args.config:
         try:
             with open(args.config, "r") as f:
-                config_data = yaml.safe_load(f)
+                config_data = yaml.load(f.read(), Loader=_YamlLoader)
                 if config_data:
                     defaults.update(config_data)
         except FileNotFoundError:
@@ -77,6 +89,16 @@ def _parse_args():
                 logging.error(f"Invalid format for --sesame-uuid: {item}")
                 sys.exit(1)
 
+    # Metrics are cached per UUID, so each UUID must map to a single name.
+    names_by_uuid: Dict[str, str] = {}
+    for name, uuid in defaults["sesame_uuids"].items():
+        if uuid in names_by_uuid:
+            logging.error(
+                f"Duplicate Sesame UUID {uuid} for {names_by_uuid[uuid]} and {name}"
+            )
+            sys.exit(1)
+        names_by_uuid[uuid] = name
+
     args.sesame_uuids = defaults["sesame_uuids"]
     return args
 
@@ -94,15 +116,23 @@ def main() -> None:
         logging.error("No Sesame UUIDs configured.")
         sys.exit(1)
 
-    if args.once:
-        update_metrics(args.sesame_uuids, api_key)
-        return
-
-    # expose metrics in a web server
-    logging.info(f"Starting Prometheus server on port {args.port}")
-    prometheus_client.start_http_server(args.port)
-
-    # update metrics forever
-    while True:
-        update_metrics(args.sesame_uuids, api_key)
-        time.sleep(_POLL_INTERVAL)
+    init(api_key, len(args.sesame_uuids))
+
+    try:
+        if args.once:
+            update_metrics(args.sesame_uuids)
+            return
+
+        # expose metrics in a web server
+        logging.info(f"Starting Prometheus server on port {args.port}")
+        prometheus_client.start_http_server(args.port)
+
+        # update metrics forever
+        while True:
+            update_metrics(args.sesame_uuids)
+            time.sleep(
+                max(_POLL_INTERVAL, seconds_until_next_refresh(args.sesame_uuids))
+            )
+    finally:
+        # Interrupt workers waiting to retry instead of blocking the exit.
+        shutdown()
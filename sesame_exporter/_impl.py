@@ -7,11 +7,17 @@ import sys
 import threading
 import time
 from concurrent import futures
-from typing import Any, Dict, Final, Mapping, Tuple
+from typing import Any, Callable, Dict, Final, Hashable, Mapping, Optional, Tuple
 
 # Third‑party imports
 import prometheus_client
 import requests
+from requests import adapters
+
+try:
+    import orjson
+except ImportError:  # orjson is optional, fall back to requests' JSON decoding
+    orjson = None  # type: ignore[assignment]
 
 logging.basicConfig(
     level=logging.INFO,
@@ -21,8 +27,18 @@ logging.basicConfig(
     ],
 )
 
-# Cache wait time before refreshing from API
+# Cache wait time before refreshing from API. This is the initial value; the
+# TTL of each device adapts to how fast its metrics change, within the bounds.
 _CACHE_TTL = 7200  # 2 hours
+_MIN_CACHE_TTL = 600  # 10 minutes
+_MAX_CACHE_TTL = 21600  # 6 hours
+
+# Change of each metric between fetches below which it is considered stable
+# (TTL grows), and at or above which it is considered volatile (TTL shrinks).
+_TTL_ADAPT_THRESHOLDS: Final[Mapping[str, Tuple[float, float]]] = {
+    "batteryVoltage": (0.01, 0.1),
+    "batteryPercentage": (1.0, 5.0),
+}
 
 _SESAME_API_URL_TEMPLATE: Final[str] = "https://app.candyhouse.co/api/sesame2/{}"
 
@@ -38,51 +54,170 @@ _METRICS_KEYS: Final[Mapping[str, prometheus_client.Gauge]] = {
     ),
 }
 
-_PROMETHEUS_LOCK = threading.Lock()
+# The metric keys above as a tuple, for iterating on every update.
+_METRIC_NAMES: Final[Tuple[str, ...]] = tuple(_METRICS_KEYS)
+
+_CACHE_TTL_GAUGE: Final[prometheus_client.Gauge] = prometheus_client.Gauge(
+    "sesame_cache_ttl_seconds", "Effective Cache TTL", labelnames=("device",)
+)
+# Labelled children of _METRICS_KEYS gauges by (device name, metric key), so that
+# updates don't go through .labels() every time. prometheus_client gauges are
+# thread-safe, and each device is only updated by one worker at a time, so no
+# additional locking is needed.
+_BOUND: Dict[Tuple[str, str], prometheus_client.Gauge] = {}
+
+# Labelled children of _CACHE_TTL_GAUGE by device name, like _BOUND.
+_TTL_BOUND: Dict[str, prometheus_client.Gauge] = {}
+
+# Last value set on each labelled child in _BOUND, so that unchanged values are
+# not written again.
+_LAST_VALUE: Dict[Tuple[str, str], float] = {}
+
+# Shared HTTP session so that TCP/TLS connections to the API are kept alive
+# across polls instead of being re-established for every request.
+# All requests go to a single host, so one connection pool is enough; its size
+# bounds the number of concurrent keep-alive connections, and is set by init()
+# to the number of devices, along with the number of workers.
+_DEFAULT_POOL_MAXSIZE: Final[int] = 10
+_SESSION = requests.Session()
+
+
+def _mount_adapter(pool_maxsize: int) -> None:
+    """Mount an HTTPS adapter keeping up to `pool_maxsize` connections alive."""
+    _SESSION.mount(
+        "https://",
+        adapters.HTTPAdapter(
+            pool_connections=1, pool_maxsize=pool_maxsize, max_retries=0
+        ),
+    )
+
+
+_mount_adapter(_DEFAULT_POOL_MAXSIZE)
+
+# Request headers carrying the API key, set once at startup by init().
+_HEADERS: Dict[str, str] = {}
 
+# Delays in seconds before each retry of a failing device (exponential backoff).
+_BACKOFF_DELAYS: Final[Tuple[int, ...]] = tuple(60 * (2**i) for i in range(8))
 
-def ttl_cache(timeout: int):
-    """Decorator to cache function results for a given timeout."""
-    cache: Dict[Tuple[Any, ...], Tuple[Any, float]] = {}
+# Set on shutdown to interrupt workers waiting to retry.
+_SHUTDOWN = threading.Event()
+
+# Monotonic time at which each (name, uuid) device is next due for a refresh.
+# Devices are skipped entirely by update_metrics until then.
+_next_refresh_at: Dict[Tuple[str, str], float] = {}
+
+# Long-lived worker pool for per-device polling. Worker threads are created on
+# demand and reused across polls rather than spawned and joined every time.
+_EXECUTOR = futures.ThreadPoolExecutor(
+    max_workers=_DEFAULT_POOL_MAXSIZE, thread_name_prefix="sesame"
+)
+
+
+def _args_cache_key(*args, **kwargs) -> Hashable:
+    """Default cache key, made of all the function arguments."""
+    return (args, tuple(kwargs.items()))
+
+
+def ttl_cache(
+    timeout: int,
+    adapt: Optional[Callable[[Any, Any, float], float]] = None,
+    key: Callable[..., Hashable] = _args_cache_key,
+):
+    """Decorator to cache function results for a given timeout.
+
+    If `adapt` is given, it is called as `adapt(old_result, new_result, ttl)` when
+    a cached entry is refreshed, and returns the TTL to use for the new entry.
+    Refreshes forced with `disable_cache=True` keep the current TTL instead.
+    `key` is called with the function arguments and returns the cache key.
+    """
+    cache: Dict[Hashable, Tuple[Any, float, float]] = {}
     lock = threading.Lock()
 
     def decorator(func):
         @functools.wraps(func)
         def wrapper(*args, disable_cache: bool = False, **kwargs) -> Tuple[Any, bool]:
-            key = (args, tuple(kwargs.items()))
+            cache_key = key(*args, **kwargs)
 
-            # Check if the function is already cached in a thread-safe manner
-            # and if the cache is still valid, and if the cache is not disabled.
-            with lock:
-                if key in cache and disable_cache is False:
-                    result, timestamp = cache[key]
-                    if time.time() - timestamp < timeout:
-                        return result, True
+            # Check if the function is already cached and if the cache is still
+            # valid, and if the cache is not disabled. A single dict lookup is
+            # atomic, so reads don't need the lock.
+            entry = cache.get(cache_key)
+            if entry is not None and disable_cache is False:
+                result, timestamp, ttl = entry
+                if time.monotonic() - timestamp < ttl:
+                    return result, True
 
             result = func(*args, **kwargs)
+            ttl = timeout
+            if entry is not None and adapt is not None:
+                # Forced refreshes happen right after a failure rather than after
+                # the TTL, so they say nothing about how fast the result changes.
+                ttl = entry[2] if disable_cache else adapt(entry[0], result, entry[2])
             with lock:
-                cache[key] = (result, time.time())
+                cache[cache_key] = (result, time.monotonic(), ttl)
 
-                return result, False
+            return result, False
 
+        def ttl_for(*args, **kwargs) -> float:
+            """Return the current TTL of the cache entry for the given arguments."""
+            entry = cache.get(key(*args, **kwargs))
+            return timeout if entry is None else entry[2]
+
+        def expires_at(*args, **kwargs) -> float:
+            """Return the monotonic time at which the cache entry expires, or 0."""
+            entry = cache.get(key(*args, **kwargs))
+            return 0.0 if entry is None else entry[1] + entry[2]
+
+        wrapper.ttl_for = ttl_for  # type: ignore[attr-defined]
+        wrapper.expires_at = expires_at  # type: ignore[attr-defined]
         return wrapper
 
     return decorator
 
 
-@ttl_cache(timeout=_CACHE_TTL)
-def _get_metrics(sesame_name: str, uuid: str, api_key: str) -> dict[str, Any]:
-    """Fetch metrics from the Sesame API."""
+def _adapt_ttl(old: Any, new: Any, ttl: float) -> float:
+    """Grow the TTL while metrics are stable, and shrink it when they change fast."""
+    stable = True
+    for key, (stable_delta, volatile_delta) in _TTL_ADAPT_THRESHOLDS.items():
+        old_value, new_value = old.get(key), new.get(key)
+        if old_value is None or new_value is None:
+            return ttl
 
-    url = _SESAME_API_URL_TEMPLATE.format(uuid)
-    headers = {"x-api-key": api_key}
+        delta = abs(float(new_value) - float(old_value))
+        if delta >= volatile_delta:
+            return max(_MIN_CACHE_TTL, ttl / 2)
+        if delta >= stable_delta:
+            stable = False
+
+    return min(_MAX_CACHE_TTL, ttl * 1.5) if stable else ttl
+
+
+@functools.lru_cache(maxsize=None)
+def _api_url(uuid: str) -> str:
+    """Return the API URL for a device, built once per UUID."""
+    return _SESAME_API_URL_TEMPLATE.format(uuid)
+
+
+# Cache by UUID only, which identifies the device.
+@ttl_cache(
+    timeout=_CACHE_TTL,
+    adapt=_adapt_ttl,
+    key=lambda sesame_name, uuid: uuid,
+)
+def _get_metrics(sesame_name: str, uuid: str) -> dict[str, Any]:
+    """Fetch metrics from the Sesame API."""
 
     try:
-        res = requests.get(url, headers=headers, timeout=10)
-        res.raise_for_status()
+        res = _SESSION.get(_api_url(uuid), headers=_HEADERS, timeout=10)
+        if res.status_code != 200:
+            res.raise_for_status()
+        if orjson is not None:
+            # Decode the raw body directly, skipping charset detection.
+            return orjson.loads(res.content)  # type: ignore[no-any-return]
         return res.json()  # type: ignore[no-any-return]
 
-    except requests.exceptions.RequestException as e:
+    except (requests.exceptions.RequestException, ValueError) as e:
         logging.error(
             "Error fetching metrics from API for %s: %s %s",
             sesame_name,
@@ -92,38 +227,66 @@ def _get_metrics(sesame_name: str, uuid: str, api_key: str) -> dict[str, Any]:
         raise RuntimeError(f"Failed to fetch metrics for {sesame_name}") from e
 
 
+def init(api_key: str, num_devices: int = 0) -> None:
+    """Set the API key used for all requests. Must be called before polling.
+
+    If `num_devices` is given, the worker pool and the connection pool are both
+    sized to it, so that all devices are polled concurrently and every worker
+    has a connection to reuse.
+    """
+    global _EXECUTOR
+
+    _HEADERS["x-api-key"] = api_key
+    if num_devices > 0:
+        _EXECUTOR.shutdown(wait=False)
+        _EXECUTOR = futures.ThreadPoolExecutor(
+            max_workers=num_devices, thread_name_prefix="sesame"
+        )
+        _mount_adapter(num_devices)
+
+
 # update metrics in multiple threads
-def update_metrics(uuids: Dict[str, str], api_key: str):
+def update_metrics(uuids: Dict[str, str]):
     """Main routine to update metrics."""
 
+    if "x-api-key" not in _HEADERS:
+        raise RuntimeError("init() must be called before update_metrics()")
+
     def _process_device(sesame_name, uuid) -> None:
         """Fetch and update metrics for a single device."""
 
-        max_retries = 8  # maximum number of retries before giving up
-        backoff_factor = 2  # exponential backoff factor
-        base_delay = 60
+        max_retries = len(_BACKOFF_DELAYS)  # maximum number of retries
         attempt = 1
 
         disable_cache = False  # flag to disable cache after a failure
 
         def _remove_gauge(metric_key: str) -> None:
             """Remove a gauge if it exists."""
-            with _PROMETHEUS_LOCK:
-                try:
-                    _METRICS_KEYS[metric_key].remove(sesame_name)
-                except KeyError:
-                    pass
+            # Labelled children are only created through _BOUND, so it tells
+            # whether there is anything to remove.
+            if _BOUND.pop((sesame_name, metric_key), None) is not None:
+                _LAST_VALUE.pop((sesame_name, metric_key), None)
+                _METRICS_KEYS[metric_key].remove(sesame_name)
+
+        def _remove_ttl_gauge() -> None:
+            """Remove the cache TTL gauge if it exists."""
+            if _TTL_BOUND.pop(sesame_name, None) is not None:
+                _CACHE_TTL_GAUGE.remove(sesame_name)
 
         def _remove_gauges() -> None:
             """Remove gauges if any of it exists."""
-            for key in _METRICS_KEYS:
+            for key in _METRIC_NAMES:
                 _remove_gauge(key)
+            _remove_ttl_gauge()
+
+        def _exponential_backoff() -> bool:
+            """Wait for the exponential backoff delay.
 
-        def _exponential_backoff() -> None:
-            """Calculate the delay for exponential backoff."""
+            Returns False if the wait was interrupted by shutdown.
+            """
             nonlocal attempt
 
-            delay = base_delay * (backoff_factor ** (attempt - 1))
+            delay = _BACKOFF_DELAYS[attempt - 1]
             logging.info(
                 "Retrying %s in %d seconds (attempt %d/%d)",
                 sesame_name,
@@ -131,16 +294,20 @@ def update_metrics(uuids: Dict[str, str], api_key: str):
                 attempt,
                 max_retries,
             )
-            time.sleep(delay)
             attempt += 1
+            return not _SHUTDOWN.wait(delay)
 
         while attempt <= max_retries:
             # Fetch metrics with exponential backoff
             try:
                 metrics, cached = _get_metrics(
-                    sesame_name, uuid, api_key, disable_cache=disable_cache
+                    sesame_name, uuid, disable_cache=disable_cache
                 )
                 if cached:
+                    # Nothing to refresh until the cached response expires.
+                    _next_refresh_at[(sesame_name, uuid)] = _get_metrics.expires_at(
+                        sesame_name, uuid
+                    )
                     return
 
             except RuntimeError as e:
@@ -152,61 +319,105 @@ def update_metrics(uuids: Dict[str, str], api_key: str):
                 )
 
                 _remove_gauges()
-                _exponential_backoff()
+                if not _exponential_backoff():
+                    return
                 disable_cache = True
                 continue
 
-            logging.info(f"Fetched new metrics ({metrics}) for {sesame_name}")
+            logging.debug("Fetched new metrics (%s) for %s", metrics, sesame_name)
 
             # Undocumented API response on failure
-            if "success" in metrics and metrics.get("success") is False:
+            if metrics.get("success") is False:
                 logging.error(
-                    f"Failed to process metrics ({metrics}) for {sesame_name}"
+                    "Failed to process metrics (%s) for %s", metrics, sesame_name
                 )
 
                 _remove_gauges()
-                _exponential_backoff()
+                if not _exponential_backoff():
+                    return
                 disable_cache = True
                 continue
 
             all_metrics_success = True
-            for key in _METRICS_KEYS:
+            for key in _METRIC_NAMES:
                 metric = metrics.get(key)
 
                 if metric is None:
-                    logging.warning(f"Failed to update metric for {sesame_name}: {key}")
+                    logging.warning(
+                        "Failed to update metric for %s: %s", sesame_name, key
+                    )
                     _remove_gauge(key)
                     all_metrics_success = False
                     continue
 
-                # Update metric in a thread-safe manner.
-                with _PROMETHEUS_LOCK:
-                    _METRICS_KEYS[key].labels(device=sesame_name).set(float(metric))
-                    logging.info(
-                        f"Updated metric for {sesame_name}: {key}: {float(metric)}"
-                    )
+                value = float(metric)
+                if _LAST_VALUE.get((sesame_name, key)) == value:
+                    continue
+
+                gauge = _BOUND.get((sesame_name, key))
+                if gauge is None:
+                    gauge = _METRICS_KEYS[key].labels(device=sesame_name)
+                    _BOUND[(sesame_name, key)] = gauge
+                gauge.set(value)
+                _LAST_VALUE[(sesame_name, key)] = value
+                logging.debug("Updated metric for %s: %s: %s", sesame_name, key, value)
 
             if not all_metrics_success:
-                logging.error(f"Failed to update some metrics for {sesame_name}")
-                _exponential_backoff()
+                logging.error("Failed to update some metrics for %s", sesame_name)
+                _remove_ttl_gauge()
+                if not _exponential_backoff():
+                    return
                 disable_cache = True
                 continue
 
+            ttl = _get_metrics.ttl_for(sesame_name, uuid)
+            ttl_gauge = _TTL_BOUND.get(sesame_name)
+            if ttl_gauge is None:
+                ttl_gauge = _CACHE_TTL_GAUGE.labels(device=sesame_name)
+                _TTL_BOUND[sesame_name] = ttl_gauge
+            ttl_gauge.set(ttl)
+            _next_refresh_at[(sesame_name, uuid)] = time.monotonic() + ttl
             return  # Return if successful
 
         # If we reach here, it means we exhausted all retries.
-        # Just give up and log an error.
+        # Just give up and log an error. A failed response stays cached, so don't
+        # poll the device again until it expires.
         logging.error(
             "Failed to fetch and update some or all metrics for %s after %d attempts",
             sesame_name,
             max_retries,
         )
+        _next_refresh_at[(sesame_name, uuid)] = _get_metrics.expires_at(
+            sesame_name, uuid
+        )
         return
 
-    # Process each device's metrics in parallel
-    with futures.ThreadPoolExecutor() as executor:
-        threads = [
-            executor.submit(_process_device, name, uuid) for name, uuid in uuids.items()
-        ]
-        for thread in threads:
-            thread.result()
+    # Process metrics of devices due for a refresh in parallel
+    now = time.monotonic()
+    threads = [
+        _EXECUTOR.submit(_process_device, name, uuid)
+        for name, uuid in uuids.items()
+        if now >= _next_refresh_at.get((name, uuid), 0)
+    ]
+    for thread in threads:
+        thread.result()
+
+
+def seconds_until_next_refresh(uuids: Dict[str, str]) -> float:
+    """Return the number of seconds until the next device is due for a refresh."""
+    now = time.monotonic()
+    return max(
+        0.0,
+        min(
+            (
+                _next_refresh_at.get((name, uuid), 0) - now
+                for name, uuid in uuids.items()
+            ),
+            default=0.0,
+        ),
+    )
+
+
+def shutdown() -> None:
+    """Interrupt devices waiting to retry so that workers can exit promptly."""
+    _SHUTDOWN.set()
@@ -1,3 +1,4 @@
+from types import SimpleNamespace
 from unittest.mock import MagicMock, patch
 
 import pytest
@@ -11,10 +12,21 @@ from sesame_exporter import _parse_args
 # Fixtures
 @pytest.fixture
 def mock_get():
-    with patch("requests.get") as mock:
+    with patch("sesame_exporter._impl._SESSION.get") as mock:
         yield mock
 
 
+@pytest.fixture(params=["orjson", "requests"])
+def json_decoder(request):
+    # Run with both the orjson and the requests JSON decoding paths
+    if request.param == "orjson":
+        pytest.importorskip("orjson")
+        yield request.param
+    else:
+        with patch.object(sesame, "orjson", None):
+            yield request.param
+
+
 @pytest.fixture
 def mock_prometheus():
     with patch("prometheus_client.Gauge") as mock:
@@ -23,32 +35,109 @@ def mock_prometheus():
 
 @pytest.fixture
 def reset_metrics():
-    # Reset metrics keys to a known state before each test
-    # This assumes _METRICS_KEYS values are mocks or we can manipulate them
-    # But in sesame.py they are real Gauges.
+    # Reset module-level polling state before each test
     # For testing update_metrics logic, we mock _METRICS_KEYS
-    pass
+    sesame._next_refresh_at.clear()
+    sesame._BOUND.clear()
+    sesame._TTL_BOUND.clear()
+    sesame._LAST_VALUE.clear()
+    sesame._HEADERS.clear()
+    yield
+    sesame._next_refresh_at.clear()
+    sesame._BOUND.clear()
+    sesame._TTL_BOUND.clear()
+    sesame._LAST_VALUE.clear()
+    sesame._HEADERS.clear()
+    sesame._SHUTDOWN.clear()
 
 
-def test_get_metrics_success(mock_get):
+@pytest.fixture
+def mock_device(reset_metrics):
+    # Mock _get_metrics and the gauges for testing update_metrics logic.
+    # Tests set the responses with mock_device.get_metrics.side_effect.
+    mocks = SimpleNamespace(
+        voltage_gauge=MagicMock(), percent_gauge=MagicMock(), ttl_gauge=MagicMock()
+    )
+    with patch.object(sesame, "_get_metrics") as mocks.get_metrics, patch.object(
+        sesame, "_CACHE_TTL_GAUGE", mocks.ttl_gauge
+    ), patch.dict(
+        sesame._METRICS_KEYS,
+        {
+            "batteryVoltage": mocks.voltage_gauge,
+            "batteryPercentage": mocks.percent_gauge,
+        },
+        clear=True,
+    ):
+        mocks.get_metrics.ttl_for.return_value = sesame._CACHE_TTL
+        sesame.init("api_key")
+        yield mocks
+
+
+def test_get_metrics_success(mock_get, json_decoder, reset_metrics):
     mock_response = MagicMock()
     mock_response.status_code = 200
     mock_response.json.return_value = {
         "batteryVoltage": 3.0,
         "batteryPercentage": 50,
     }
+    mock_response.content = b'{"batteryVoltage": 3.0, "batteryPercentage": 50}'
     mock_get.return_value = mock_response
 
-    metrics, cached = sesame._get_metrics("HOME_FRONT", "uuid", "api_key")
+    sesame.init("api_key")
+    metrics, cached = sesame._get_metrics("HOME_FRONT", f"uuid_{json_decoder}")
     assert metrics == {"batteryVoltage": 3.0, "batteryPercentage": 50}
     assert cached is False
+    mock_get.assert_called_once_with(
+        f"https://app.candyhouse.co/api/sesame2/uuid_{json_decoder}",
+        headers={"x-api-key": "api_key"},
+        timeout=10,
+    )
+
+
+def test_init_sizes_pools(monkeypatch, reset_metrics):
+    # Keep the module's worker and connection pools for other tests
+    monkeypatch.setattr(sesame, "_EXECUTOR", MagicMock())
+    monkeypatch.setitem(
+        sesame._SESSION.adapters, "https://", sesame._SESSION.adapters["https://"]
+    )
+
+    sesame.init("api_key", 25)
+
+    assert sesame._EXECUTOR._max_workers == 25
+    assert sesame._SESSION.adapters["https://"]._pool_maxsize == 25
+    sesame._EXECUTOR.shutdown()
 
 
 def test_get_metrics_failure(mock_get):
     mock_get.side_effect = requests.exceptions.RequestException("API error")
 
     with pytest.raises(RuntimeError):
-        sesame._get_metrics("HOME_FRONT", "uuid_fail", "api_key")
+        sesame._get_metrics("HOME_FRONT", "uuid_fail")
+
+
+def test_get_metrics_http_error(mock_get):
+    mock_response = MagicMock()
+    mock_response.status_code = 500
+    mock_response.raise_for_status.side_effect = requests.exceptions.HTTPError(
+        "500 Server Error"
+    )
+    mock_get.return_value = mock_response
+
+    with pytest.raises(RuntimeError):
+        sesame._get_metrics("HOME_FRONT", "uuid_http_error")
+
+
+def test_get_metrics_invalid_json(mock_get, json_decoder):
+    mock_response = MagicMock()
+    mock_response.status_code = 200
+    mock_response.json.side_effect = requests.exceptions.JSONDecodeError(
+        "Expecting value", "not json", 0
+    )
+    mock_response.content = b"not json"
+    mock_get.return_value = mock_response
+
+    with pytest.raises(RuntimeError):
+        sesame._get_metrics("HOME_FRONT", f"uuid_invalid_{json_decoder}")
 
 
 def test_ttl_cache():
@@ -81,8 +170,78 @@ def test_ttl_cache():
     assert mock_func.call_count == 2
 
 
-@patch("sesame_exporter._impl.time.sleep")  # Mock sleep for backoff
-def test_update_metrics(mock_sleep, mock_get):
+def test_ttl_cache_key():
+    mock_func = MagicMock()
+    mock_func.return_value = "test_result"
+
+    cached_func = sesame.ttl_cache(timeout=60, key=lambda a, b: a)(mock_func)
+
+    assert cached_func("a", "b") == ("test_result", False)
+    # Same key, so cached regardless of the other argument
+    assert cached_func("a", "c") == ("test_result", True)
+    assert cached_func("b", "b") == ("test_result", False)
+    assert mock_func.call_count == 2
+
+
+@patch("sesame_exporter._impl.time.monotonic")
+def test_ttl_cache_adapt(mock_monotonic):
+    mock_monotonic.return_value = 0
+    mock_func = MagicMock()
+    mock_func.return_value = "test_result"
+    adapt = MagicMock(return_value=10)
+
+    cached_func = sesame.ttl_cache(timeout=5, adapt=adapt)(mock_func)
+
+    # Nothing to adapt before the first refresh
+    assert cached_func.ttl_for() == 5
+    assert cached_func() == ("test_result", False)
+    assert cached_func.ttl_for() == 5
+    assert cached_func.expires_at() == 5
+    adapt.assert_not_called()
+
+    # Refresh after the timeout adapts the TTL
+    mock_monotonic.return_value = 6
+    assert cached_func() == ("test_result", False)
+    adapt.assert_called_once_with("test_result", "test_result", 5)
+    assert cached_func.ttl_for() == 10
+    assert cached_func.expires_at() == 16
+
+    # The adapted TTL decides cache hits
+    mock_monotonic.return_value = 15
+    assert cached_func() == ("test_result", True)
+    mock_monotonic.return_value = 17
+    assert cached_func() == ("test_result", False)
+    assert adapt.call_count == 2
+
+    # Forced refreshes keep the TTL without adapting it
+    adapt.return_value = 20
+    assert cached_func(disable_cache=True) == ("test_result", False)
+    assert adapt.call_count == 2
+    assert cached_func.ttl_for() == 10
+
+
+def test_adapt_ttl():
+    old = {"batteryVoltage": 3.0, "batteryPercentage": 50}
+
+    # Stable metrics grow the TTL, up to the maximum
+    assert sesame._adapt_ttl(old, dict(old), 1000) == 1500
+    assert sesame._adapt_ttl(old, dict(old), 20000) == sesame._MAX_CACHE_TTL
+
+    # A large change shrinks the TTL, down to the minimum
+    changed = {"batteryVoltage": 2.8, "batteryPercentage": 50}
+    assert sesame._adapt_ttl(old, changed, 2000) == 1000
+    assert sesame._adapt_ttl(old, changed, 1000) == sesame._MIN_CACHE_TTL
+
+    # A moderate change, or a response without metrics, keeps the TTL
+    moderate = {"batteryVoltage": 3.0, "batteryPercentage": 48}
+    assert sesame._adapt_ttl(old, moderate, 2000) == 2000
+    assert sesame._adapt_ttl(old, {"success": False}, 2000) == 2000
+
+
+@patch.object(sesame._SHUTDOWN, "wait", return_value=False)  # Mock backoff wait
+def test_update_metrics(mock_wait, mock_get, reset_metrics):
+    sesame.init("api_key")
+
     # Mock the API response
     mock_response = MagicMock()
     mock_response.status_code = 200
@@ -91,6 +250,9 @@ def test_update_metrics(mock_sleep, mock_get):
         "batteryPercentage": 50,
         "success": True,
     }
+    mock_response.content = (
+        b'{"batteryVoltage": 3.0, "batteryPercentage": 50, "success": true}'
+    )
     mock_get.return_value = mock_response
 
     # Mock Gauges
@@ -106,7 +268,7 @@ def test_update_metrics(mock_sleep, mock_get):
         clear=True,
     ):
         uuids = {"HOME_FRONT": "uuid1"}
-        sesame.update_metrics(uuids, "api_key")
+        sesame.update_metrics(uuids)
 
     # Verify calls
     mock_voltage_gauge.labels.assert_called_with(device="HOME_FRONT")
@@ -115,6 +277,108 @@ def test_update_metrics(mock_sleep, mock_get):
     mock_percent_gauge.labels.return_value.set.assert_called_with(50.0)
 
 
+def test_update_metrics_requires_init(reset_metrics):
+    with pytest.raises(RuntimeError):
+        sesame.update_metrics({"HOME_FRONT": "uuid1"})
+
+
+def test_update_metrics_skips_until_refresh_due(mock_device):
+    uuids = {"HOME_FRONT": "uuid1"}
+    metrics = {"batteryVoltage": 3.0, "batteryPercentage": 50}
+    mock_device.get_metrics.return_value = (metrics, False)
+
+    sesame.update_metrics(uuids)
+    assert mock_device.get_metrics.call_count == 1
+    assert sesame.seconds_until_next_refresh(uuids) > 0
+
+    # Not due yet, so the device is not polled again
+    sesame.update_metrics(uuids)
+    assert mock_device.get_metrics.call_count == 1
+
+
+@patch.object(sesame._SHUTDOWN, "wait", return_value=False)  # Mock backoff wait
+def test_update_metrics_retries_with_backoff(mock_wait, mock_get, reset_metrics):
+    sesame.init("api_key")
+    mock_get.side_effect = requests.exceptions.RequestException("API error")
+
+    sesame.update_metrics({"HOME_FRONT": "uuid_retry"})
+
+    assert mock_get.call_count == len(sesame._BACKOFF_DELAYS)
+    assert [c.args[0] for c in mock_wait.call_args_list] == list(sesame._BACKOFF_DELAYS)
+
+
+@patch.object(sesame._SHUTDOWN, "wait", return_value=False)  # Mock backoff wait
+def test_update_metrics_waits_for_cache_after_giving_up(
+    mock_wait, mock_get, reset_metrics
+):
+    sesame.init("api_key")
+    mock_response = MagicMock()
+    mock_response.status_code = 200
+    mock_response.json.return_value = {"success": False}
+    mock_response.content = b'{"success": false}'
+    mock_get.return_value = mock_response
+    uuids = {"HOME_FRONT": "uuid_gave_up"}
+
+    sesame.update_metrics(uuids)
+    assert mock_get.call_count == len(sesame._BACKOFF_DELAYS)
+
+    # The failed response stays cached, so the device is not polled until then
+    assert sesame.seconds_until_next_refresh(uuids) > 0
+    sesame._next_refresh_at.clear()  # Poll again anyway, hitting the cache
+    sesame.update_metrics(uuids)
+    assert mock_get.call_count == len(sesame._BACKOFF_DELAYS)
+    assert sesame.seconds_until_next_refresh(uuids) > 0
+
+
+def test_update_metrics_stops_retrying_on_shutdown(mock_get, reset_metrics):
+    sesame.init("api_key")
+    mock_get.side_effect = requests.exceptions.RequestException("API error")
+
+    sesame.shutdown()
+    sesame.update_metrics({"HOME_FRONT": "uuid_shutdown"})
+
+    assert mock_get.call_count == 1
+
+
+def test_update_metrics_reuses_labelled_gauges(mock_device):
+    uuids = {"HOME_FRONT": "uuid1"}
+    mock_device.get_metrics.side_effect = [
+        ({"batteryVoltage": 3.0, "batteryPercentage": 50}, False),
+        ({"batteryVoltage": 2.9, "batteryPercentage": 50}, False),
+    ]
+
+    sesame.update_metrics(uuids)
+    sesame._next_refresh_at.clear()  # Force the next refresh
+    sesame.update_metrics(uuids)
+
+    assert mock_device.voltage_gauge.labels.call_count == 1
+    assert mock_device.voltage_gauge.labels.return_value.set.call_count == 2
+    # Unchanged values are not set again
+    mock_device.percent_gauge.labels.return_value.set.assert_called_once_with(50.0)
+
+
+def test_update_metrics_removes_gauges_on_failure(mock_device):
+    uuids = {"HOME_FRONT": "uuid1"}
+    metrics = {"batteryVoltage": 3.0, "batteryPercentage": 50}
+    mock_device.get_metrics.side_effect = [
+        (metrics, False),
+        RuntimeError("API error"),
+    ]
+
+    sesame.update_metrics(uuids)
+    sesame._next_refresh_at.clear()  # Force the next refresh
+    sesame.shutdown()  # Don't wait to retry
+    sesame.update_metrics(uuids)
+
+    mock_device.voltage_gauge.remove.assert_called_once_with("HOME_FRONT")
+    assert ("HOME_FRONT", "batteryVoltage") not in sesame._BOUND
+    mock_device.ttl_gauge.labels.return_value.set.assert_called_once_with(
+        sesame._CACHE_TTL
+    )
+    mock_device.ttl_gauge.remove.assert_called_once_with("HOME_FRONT")
+    assert "HOME_FRONT" not in sesame._TTL_BOUND
+
+
 def test_parse_args_defaults():
     with patch("sys.argv", ["sesame.py"]):
         args = _parse_args()
@@ -181,3 +445,12 @@ def test_parse_args_override(tmp_path):
         assert args.sesame_uuids["ConfigDoor"] == "9999"
         assert args.sesame_uuids["OverrideMe"] == "New"
         assert args.sesame_uuids["New"] == "1111"
+
+
+def test_parse_args_duplicate_uuid():
+    with patch(
+        "sys.argv",
+        ["sesame.py", "--sesame-uuid", "Door=1234", "--sesame-uuid", "Gate=1234"],
+    ):
+        with pytest.raises(SystemExit):
+            _parse_args()